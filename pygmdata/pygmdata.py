@@ -1,7 +1,15 @@
+import bz2
 import copy
+import fnmatch
+import gzip
+import lzma
 import os
 import io
 import sys
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
 from requests_toolbelt import MultipartEncoder
 import mimetypes
@@ -10,6 +18,15 @@ from pathlib import Path
 from PIL import Image
 import logging
 
+# Codecs that can be applied to objects on their way into GM-Data.
+# Each name maps to the stdlib opener used to compress a stream and a
+# factory for the incremental decompressor used when streaming it back out.
+CODECS = {
+    "gzip": (gzip.open, lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)),
+    "bz2": (bz2.open, bz2.BZ2Decompressor),
+    "lzma": (lzma.open, lzma.LZMADecompressor),
+}
+
 
 class Data:
     def __init__(self, base_url, **kwargs):
@@ -24,12 +41,16 @@ class Data:
             - logfile - File to save the log to. If not specified
             - log_level - Level of verbosity to log. Defaults to warning.
                 Can be integer or string.
+            - compression - Default codec used to compress uploads and
+                appends. One of the keys of `CODECS` ("gzip", "bz2",
+                "lzma"). Defaults to no compression.
         """
         self.base_url = base_url
         self.headers = {}
         self.data = None
         self.hierarchy = {}
         self.log = None
+        self.compression = None
         level = "warning"
 
         for key, value in kwargs.items():
@@ -41,6 +62,8 @@ class Data:
                 self.log = self.start_logger(value)
             if "log_level" == key.lower():
                 level = value
+            if "compression" == key.lower():
+                self.compression = self._resolve_compression(value)
         if not self.log:
             self.log = self.start_logger()
         # Set the level now that the logger exists
@@ -122,6 +145,8 @@ class Data:
             from the parent if creating a new file.
             - mimetype - Mimetype to be used as a header value to be uploaded.
             If not supplied it will make it's best guess at the value.
+            - custom - Dictionary merged into the object's custom metadata.
+            Keys with a value of None are removed from it.
         :return: Metadata dictionary
         """
         self.log.debug("Create Metadata object_policy {}".format(object_policy))
@@ -189,10 +214,15 @@ class Data:
                 meta['security'] = r.json()['security']
                 self.log.debug("Getting security: {}".format(meta['security']))
                 r.close()
+
+        if kwargs.get("custom") is not None:
+            custom = dict(meta.get("custom") or {})
+            custom.update(kwargs["custom"])
+            meta["custom"] = {k: v for k, v in custom.items() if v is not None}
         return meta
 
     def upload_file(self, local_filename, data_filename, object_policy=None,
-                    **kwargs):
+                    compression=None, **kwargs):
         """Upload a file from the local filesystem to GM-Data.
 
         This will upload a file from the local file system to GM-Data.
@@ -206,6 +236,10 @@ class Data:
             If not supplied and updating a file, it will keep what is already in
             Data. If creating a new file and not supplied, it will likely fail
             as a file will be uploaded that cannot be accessed by anyone.
+        :param compression: Codec to compress the file with before it is
+            sent. The codec is recorded in the object's custom metadata so
+            reads decompress it transparently. Defaults to the codec given
+            when the class was made, False disables compression.
         :param kwargs: extra keywords to be set:
             - security - The security tag of the given file. If not supplied
             it will keep what is already there or it will use the field
@@ -218,18 +252,26 @@ class Data:
                                                               object_policy))
         self.log.debug("{}".format(type(object_policy)))
         mimetype = mimetypes.guess_type(local_filename)
+        codec = self._resolve_compression(compression)
+        custom = {"compression": codec, "uncompressed_size": None}
+        if codec:
+            custom["uncompressed_size"] = os.path.getsize(local_filename)
         meta = self.create_meta(data_filename, local_filename=local_filename,
-                                object_policy=object_policy, **kwargs)
+                                object_policy=object_policy, custom=custom,
+                                **kwargs)
 
         # lets get to writing! Do a multipart upload
-        with open(local_filename, 'rb') as f:
+        f = open(local_filename, 'rb')
+        if codec:
+            f = self._compress_stream(f, codec)
+        with f:
             multipart_data = MultipartEncoder(
                 fields={"meta": json.dumps([meta]),
                         "blob": (local_filename, f, mimetype[0])}
             )
 
             headers = copy.copy(self.headers)
-            headers['Content-length'] = str(os.path.getsize(local_filename))
+            headers['Content-length'] = str(os.fstat(f.fileno()).st_size)
             headers['Content-Type'] = multipart_data.content_type
             r = requests.post(self.base_url+"/write", data=multipart_data,
                               headers=headers)
@@ -353,16 +395,7 @@ class Data:
         if not part:
             # figure out the next part number
             # start by listing them off
-            r = requests.get(self.base_url+"/list/{}/".format(oid),
-                             headers=self.headers)
-            self.log.debug("The sent request in part")
-            self.log.debug("URL: {}".format(r.request.url))
-            self.log.debug("Body: {}".format(r.request.body))
-            self.log.debug("Headers: {}".format(r.request.headers))
-            # get only the filenames
-            names = [name['name'] for name in r.json() if 'isfile' in name.keys()]
-            r.close()
-            names.sort()
+            names = [part['name'] for part in self._list_parts(oid)]
             self.log.debug("names: {}".format(names))
 
             # take the last one and increment it
@@ -373,7 +406,8 @@ class Data:
 
         return part
 
-    def append_file(self, local_filename, data_filename, object_policy=None):
+    def append_file(self, local_filename, data_filename, object_policy=None,
+                    compression=None):
         """Append an uploaded file with another file on disk
 
         :param local_filename: Filename on disk that will be appended to the
@@ -383,15 +417,19 @@ class Data:
             object with this value or will make a new object with this policy.
             If not supplied for either, it will make a best effort to
             come up with a good response
+        :param compression: Codec to compress the new part with. Defaults to
+            the codec given when the class was made.
         :return: True on success
         """
         part = self.get_part(data_filename, object_policy=object_policy)
 
         a = self.upload_file(local_filename, "{}/{}".format(data_filename, part),
-                             object_policy=object_policy)
+                             object_policy=object_policy,
+                             compression=compression)
         return a
 
-    def append_data(self, data, data_filename, object_policy=None):
+    def append_data(self, data, data_filename, object_policy=None,
+                    compression=None, custom=None):
         """Append the given filename with the given data in memory
 
         :param data: Data to append to a file. Remember to add line endings
@@ -401,41 +439,42 @@ class Data:
             object with this value or will make a new object with this policy.
             If not supplied for either, it will make a best effort to
             come up with a good response
+        :param compression: Codec to compress the new part with. Defaults to
+            the codec given when the class was made.
+        :param custom: Optional dictionary to store in the new part's custom
+            metadata
         :return: True on success
         """
         part = self.get_part(data_filename, object_policy=object_policy)
 
         mimetype = mimetypes.guess_type(data_filename)
+        codec = self._resolve_compression(compression)
+
+        if isinstance(data, str):
+            data = data.encode()
+        custom = dict(custom or {})
+        custom.update({"compression": codec, "uncompressed_size": None})
+        if codec:
+            custom["uncompressed_size"] = len(data)
 
         meta = self.create_meta("{}/{}".format(data_filename, part),
                                 object_policy=object_policy,
-                                mimetype=mimetype)
+                                mimetype=mimetype, custom=custom)
 
-        if isinstance(data, str):
-            with io.StringIO(data) as f:
-                multipart_data = MultipartEncoder(
-                    fields={"meta": json.dumps([meta]),
-                            "blob": ("{}/{}".format(data_filename, part),
-                                     f, mimetype[0])}
-                )
-
-                headers = copy.copy(self.headers)
-                headers['Content-Type'] = multipart_data.content_type
-                r = requests.post(self.base_url + "/write", data=multipart_data,
-                                  headers=headers)
+        f = io.BytesIO(data)
+        if codec:
+            f = self._compress_stream(f, codec)
+        with f:
+            multipart_data = MultipartEncoder(
+                fields={"meta": json.dumps([meta]),
+                        "blob": ("{}/{}".format(data_filename, part),
+                                 f, mimetype[0])}
+            )
 
-        else:
-            with io.BytesIO(data) as f:
-                multipart_data = MultipartEncoder(
-                    fields={"meta": json.dumps([meta]),
-                            "blob": ("{}/{}".format(data_filename, part),
-                                     f, mimetype[0])}
-                )
-
-                headers = copy.copy(self.headers)
-                headers['Content-Type'] = multipart_data.content_type
-                r = requests.post(self.base_url + "/write", data=multipart_data,
-                                  headers=headers)
+            headers = copy.copy(self.headers)
+            headers['Content-Type'] = multipart_data.content_type
+            r = requests.post(self.base_url + "/write", data=multipart_data,
+                              headers=headers)
 
         self.log.debug("The append_data sent request")
         self.log.debug("URL: {}".format(r.request.url))
@@ -445,19 +484,276 @@ class Data:
         self.log.debug(r.status_code)
         self.log.debug(r.json())
         r.close()
-        f.flush()
 
         if r.ok:
             self.hierarchy[data_filename] = r.json()[0]["oid"]
 
         return r.ok
 
+    def list_parts(self, data_filename):
+        """List the parts of an appended file
+
+        Parts retired by `compact` are left out, so the listed parts hold
+        every appended byte exactly once.
+
+        :param data_filename: Appended file in GM Data
+        :return: List of the metadata of every live part, sorted by name.
+            Empty if the file cannot be found
+        """
+        oid = self.find_file(data_filename)
+        if not oid:
+            self.log.warning("Cannot find file in GM-Data to list.")
+            return []
+        return self._live_parts(self._list_parts(oid))
+
+    def stream_parts(self, data_filename, chunk_size=8192):
+        """Stream the contents of an appended file part by part
+
+        The parts from `list_parts` are streamed in order and decompressed
+        if they were appended with compression.
+
+        :param data_filename: Appended file in GM Data
+        :param chunk_size: Size of chunks to be used. Defaults to 8192
+        :return: Generator of the bytes of the file
+        """
+        for part in self.list_parts(data_filename):
+            with requests.get(self.base_url + "/stream/{}".format(part['oid']),
+                              headers=self.headers, stream=True) as r:
+                r.raise_for_status()
+                chunks = r.iter_content(chunk_size=chunk_size)
+                yield from self._decompress_chunks(
+                    chunks, self._part_compression(part))
+
+    def append_array(self, array, data_filename, object_policy=None,
+                     compression=None):
+        """Append a chunk of rows to an array dataset in GM-Data
+
+        Every chunk is stored as its own part holding a `.npy` file. The
+        dtype and shape of the chunk are kept in the part's custom metadata
+        so `read_array` can work out which parts hold which rows without
+        downloading them. Needs numpy, installed with
+        ``pip install pygmdata[array]``.
+
+        :param array: NumPy array (or anything `np.asarray` accepts) with
+            at least one dimension. Rows are taken along the first axis.
+        :param data_filename: Array dataset to append to
+        :param object_policy: Object Policy to use. Will update an existing
+            object with this value or will make a new object with this policy.
+            If not supplied for either, it will make a best effort to
+            come up with a good response
+        :param compression: Codec to compress the new part with. Defaults to
+            the codec given when the class was made.
+        :return: True on success
+        """
+        import numpy as np
+
+        array = np.asarray(array)
+        if array.ndim == 0:
+            raise ValueError("Cannot append a 0-d array, "
+                             "it has no rows to append")
+
+        oid = self.find_file(data_filename)
+        if oid:
+            parts = [part for part in self.list_parts(data_filename)
+                     if self._is_array_part(part)]
+            if parts:
+                custom = parts[0]['custom']
+                if (np.dtype(custom['dtype']) != array.dtype or
+                        list(custom['shape'][1:]) != list(array.shape[1:])):
+                    raise ValueError(
+                        "Array with dtype {} and shape {} does not match "
+                        "dataset {} with dtype {} and row shape {}".format(
+                            array.dtype.str, array.shape, data_filename,
+                            custom['dtype'], custom['shape'][1:]))
+
+        with io.BytesIO() as f:
+            np.save(f, array, allow_pickle=False)
+            data = f.getvalue()
+
+        custom = {"dtype": array.dtype.str, "shape": list(array.shape)}
+        return self.append_data(data, data_filename,
+                                object_policy=object_policy,
+                                compression=compression, custom=custom)
+
+    def read_array(self, data_filename, start=None, stop=None,
+                   cache_dir=None):
+        """Read an array dataset written with `append_array`
+
+        Only the parts holding rows between start and stop are fetched.
+        Chunks are loaded without copying, either memory mapped from the
+        local cache or straight from the downloaded buffer, and only
+        concatenated if more than one part is needed. Like `append_array`
+        this needs the ``array`` extra.
+
+        :param data_filename: Array dataset in GM Data to read
+        :param start: First row to read. Defaults to the first row
+        :param stop: Row to stop reading at, exclusive. Defaults to the end
+        :param cache_dir: Optional directory to cache parts in. Cached parts
+            are reused as long as the part has not been rewritten in GM-Data
+        :return: NumPy array of the selected rows. Read only if it could be
+            returned without a copy
+        """
+        import numpy as np
+
+        oid = self.find_file(data_filename)
+        if not oid:
+            self.log.warning("Cannot find file in GM-Data to read.")
+            return None
+
+        parts = [part for part in self.list_parts(data_filename)
+                 if self._is_array_part(part)]
+        if not parts:
+            self.log.warning("{} has no array parts.".format(data_filename))
+            return None
+
+        dtype = np.dtype(parts[0]['custom']['dtype'])
+        row_shape = tuple(parts[0]['custom']['shape'][1:])
+        total = sum(part['custom']['shape'][0] for part in parts)
+        start, stop, _ = slice(start, stop).indices(total)
+
+        chunks = []
+        offset = 0
+        for part in parts:
+            rows = part['custom']['shape'][0]
+            lo = max(start - offset, 0)
+            hi = min(stop - offset, rows)
+            offset += rows
+            if lo >= hi:
+                continue
+            self.log.debug("Reading rows {}:{} of part {}".format(
+                lo, hi, part['name']))
+            chunks.append(self._load_array_part(part, cache_dir)[lo:hi])
+
+        if not chunks:
+            return np.empty((0,) + row_shape, dtype=dtype)
+        if len(chunks) == 1:
+            return chunks[0]
+        return np.concatenate(chunks)
+
+    def compact(self, data_filename, target_part_size=64 * 1024 * 1024,
+                object_policy=None):
+        """Merge the small parts of an appended file into larger parts
+
+        Consecutive parts are streamed into a temporary file until adding
+        the next one would exceed target_part_size. The merged data is
+        written over the first part of the run, so every part name stays one
+        made by `_increment_str` and the order of the data is kept.
+
+        Merging retires the rest of the run before deleting it: the merged
+        part lists the names it replaces under "replaces" in its custom
+        metadata. `list_parts`, `stream_parts` and `read_array` drop
+        retired parts, so readers using them see every byte once whether or
+        not the deletes have happened yet. If a delete
+        fails or compaction is interrupted, the next call deletes the
+        leftover retired parts before merging anything else.
+
+        Compaction is not safe for a reader that listed the parts before a
+        run was merged and is still working through that listing. It may
+        read the merged part and then the originals it replaces, or get a
+        404 for an original that has since been deleted. Such readers have
+        to list the parts again.
+
+        The newest part is never touched so that concurrent appends keep
+        incrementing from it. Parts are only merged with neighbours stored
+        with the same compression, as compressed streams can simply be
+        concatenated. Parts written by `append_array` and parts whose size
+        is unknown are left as they are.
+
+        :param data_filename: Appended file in GM Data to compact
+        :param target_part_size: Size in bytes the merged parts should grow
+            up to. Defaults to 64 MiB
+        :param object_policy: Object Policy to use for the merged parts. If
+            not supplied the policy of the first part of each run is kept
+        :return: True if parts were merged or deleted, None if there was
+            nothing to compact and False if a part could not be written or
+            deleted
+        """
+        oid = self.find_file(data_filename)
+        if not oid:
+            self.log.warning("Cannot find file in GM-Data to compact.")
+            return False
+
+        parts = self._list_parts(oid)
+        changed = False
+
+        # finish deleting parts retired by an earlier, interrupted compaction
+        live = self._live_parts(parts)
+        for part in parts:
+            if part in live:
+                continue
+            self.log.debug("Deleting retired part {}".format(part['name']))
+            if not self.delete_file("{}/{}".format(data_filename,
+                                                   part['name'])):
+                return False
+            changed = True
+        parts = live
+
+        if len(parts) < 3:
+            self.log.debug("Not enough parts to compact: {}".format(parts))
+            return True if changed else None
+
+        for part in parts[:-1]:
+            if part.get('size') is None:
+                r = requests.get(self.base_url + '/props/{}'.format(
+                    part['oid']), headers=self.headers)
+                part['size'] = r.json().get('size')
+                r.close()
+
+        # leave the newest part alone
+        for run in self._plan_runs(parts[:-1], target_part_size):
+            if len(run) < 2:
+                continue
+            self.log.debug("Merging parts {}".format(
+                [part['name'] for part in run]))
+            if not self._merge_parts(data_filename, run, object_policy):
+                return False
+            changed = True
+            for part in run[1:]:
+                if not self.delete_file("{}/{}".format(data_filename,
+                                                       part['name'])):
+                    return False
+        return True if changed else None
+
+    def delete_file(self, data_filename):
+        """Delete a file or directory in GM-Data
+
+        :param data_filename: Filename in GM Data to delete
+        :return: True on success
+        """
+        oid = self.find_file(data_filename)
+        if not oid:
+            self.log.warning("Cannot find file in GM-Data to delete.")
+            return False
+
+        r = requests.get(self.base_url + '/props/{}'.format(oid),
+                         headers=self.headers)
+        meta = r.json()
+        r.close()
+        meta['action'] = "D"
+
+        files = {
+            'file': ('meta', json.dumps([meta]))}
+        r = requests.post(self.base_url + "/write", files=files,
+                          headers=self.headers)
+        self.log.debug("The delete_file sent request")
+        self.log.debug("URL: {}".format(r.request.url))
+        self.log.debug("Response")
+        self.log.debug(r.status_code)
+
+        ok = r.ok
+        r.close()
+        if ok:
+            self.hierarchy.pop(data_filename, None)
+
+        return ok
+
     def download_file(self, file, local_filename, chunk_size=8192):
         """Downloads a file onto the local file system.
 
         Streams a file in chunks of 8192 to write the given file onto the
         filesystem. Streaming with chunks of this size can save lots of
-        memory when downloading large files.
+        memory when downloading large files. Files uploaded with compression
+        are decompressed as they are streamed.
 
         :param file: File within GM-Data to download
         :param local_filename: Filename to be written onto the local filesystem
@@ -466,17 +762,100 @@ class Data:
         """
         oid = self.find_file(file)
         if oid:
+            codec = self._get_compression(oid)
             with requests.get(self.base_url+"/stream/{}".format(oid),
                               headers=self.headers, stream=True) as r:
                 r.raise_for_status()
+                chunks = r.iter_content(chunk_size=chunk_size)
                 with open(local_filename, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=chunk_size):
+                    for chunk in self._decompress_chunks(chunks, codec):
 
                         f.write(chunk)
             return local_filename
         else:
             self.log.warning("Cannot find file in GM-Data to download.")
 
+    def download_tree(self, data_dir, local_dir, max_workers=4, include=None,
+                      exclude=None, chunk_size=8192):
+        """Download a directory and everything below it from GM-Data.
+
+        The subtree is listed again to find the files and the directory
+        layout is recreated under local_dir. Objects whose names would
+        place them outside local_dir are counted as failed. Files are streamed concurrently into
+        temporary files next to their destination and renamed into place
+        once complete, so an interrupted download never leaves a partial
+        file behind. Each file's modification time is set from the object's
+        tstamp, and files whose local copy has both the expected size and
+        modification time are skipped.
+
+        :param data_dir: Directory within GM-Data to download
+        :param local_dir: Directory on the local filesystem to download into
+        :param max_workers: Number of files to download at once. Defaults to 4
+        :param include: Optional list of glob patterns. Only paths relative to
+            data_dir matching one of them are downloaded
+        :param exclude: Optional list of glob patterns. Paths relative to
+            data_dir matching any of them are not downloaded
+        :param chunk_size: Size of chunks to be used. Defaults to 8192
+        :return: Dictionary summarizing the download in the format of
+            ::
+
+                {"files": 10, "skipped": 2, "failed": 0, "bytes": 1048576,
+                "seconds": 1.5, "bytes_per_second": 699050.7}
+
+        """
+        targets = self._select_tree(data_dir, include, exclude)
+        self.log.debug("Downloading {} objects from {}".format(len(targets),
+                                                               data_dir))
+
+        # files get the same permissions as ones written with open()
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+
+        os.makedirs(local_dir, exist_ok=True)
+        root = os.path.realpath(local_dir)
+        summary = {"files": 0, "skipped": 0, "failed": 0, "bytes": 0}
+        begin = time.time()
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {}
+            for rel, oid in targets.items():
+                # never let object names from the server escape local_dir
+                local_filename = os.path.realpath(
+                    os.path.join(root, *rel.split("/")))
+                if (local_filename == root or
+                        os.path.commonpath([root, local_filename]) != root):
+                    self.log.error("Refusing to download {} outside of "
+                                   "{}".format(rel, local_dir))
+                    summary["failed"] += 1
+                    continue
+                future = pool.submit(self._download_tree_object, oid,
+                                     local_filename, chunk_size, mode)
+                futures[future] = rel
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    self.log.error("Could not download {}: {}".format(
+                        futures[future], e))
+                    summary["failed"] += 1
+                    continue
+                if result is None:
+                    # a directory
+                    continue
+                if result is False:
+                    summary["skipped"] += 1
+                else:
+                    summary["files"] += 1
+                    summary["bytes"] += result
+
+        summary["seconds"] = time.time() - begin
+        summary["bytes_per_second"] = (summary["bytes"] / summary["seconds"]
+                                       if summary["seconds"] else 0.0)
+        self.log.info("Downloaded {files} files ({bytes} bytes) in "
+                      "{seconds:.2f}s, {bytes_per_second:.0f} bytes/s. "
+                      "Skipped {skipped}, failed {failed}".format(**summary))
+        return summary
+
     def get_buffered_steam(self, file):
         """Get a file as a data stream into memory
 
@@ -486,10 +865,15 @@ class Data:
         oid = self.find_file(file)
 
         if oid:
+            codec = self._get_compression(oid)
             r = requests.get(self.base_url+"/stream/{}".format(oid),
                              headers=self.headers, stream=True)
             r.raise_for_status()
             r.raw.decode_content = True
+            if codec:
+                chunks = r.iter_content(chunk_size=8192)
+                return io.BytesIO(b"".join(self._decompress_chunks(chunks,
+                                                                   codec)))
             return io.BytesIO(r.content)
         else:
             self.log.warning("Cannot find file in GM-Data to download.")
@@ -504,6 +888,8 @@ class Data:
         - `application/json` return a dictionary in json format
         - `text/plain` return decoded text of object
 
+        Files uploaded with compression are decompressed first.
+
         :param file: File name within GM-Data to download
         :return: Object
         """
@@ -513,18 +899,25 @@ class Data:
             self.log.warning("Cannot find file in GM-Data to download.")
             return None
 
+        codec = self._get_compression(oid)
         r = requests.get(self.base_url+"/stream/{}".format(oid),
                          headers=self.headers, stream=True)
         r.raise_for_status()
         r.raw.decode_content = True
 
+        if codec:
+            chunks = r.iter_content(chunk_size=8192)
+            body = io.BytesIO(b"".join(self._decompress_chunks(chunks, codec)))
+        else:
+            body = r.raw
+
         if r.headers['Content-Type'] == 'image/jpeg':
-            im = Image.open(r.raw)
+            im = Image.open(body)
             return im
         if r.headers['Content-Type'] == 'application/json':
-            return r.json()
+            return json.load(body)
         if r.headers['Content-Type'] == 'text/plain':
-            return r.content.decode()
+            return body.read().decode()
 
     # --- Utility functions
 
@@ -551,6 +944,390 @@ class Data:
         except KeyError:
             return None
 
+    def _list_parts(self, oid):
+        """List the parts of an appended file
+
+        :param oid: The GM Data oid of the appended file's directory
+        :return: List of the metadata of every part, sorted by name
+        """
+        r = requests.get(self.base_url+"/list/{}/".format(oid),
+                         headers=self.headers)
+        self.log.debug("The sent request in part")
+        self.log.debug("URL: {}".format(r.request.url))
+        self.log.debug("Body: {}".format(r.request.body))
+        self.log.debug("Headers: {}".format(r.request.headers))
+        # get only the files
+        parts = [part for part in r.json() if 'isfile' in part.keys()]
+        r.close()
+        parts.sort(key=lambda part: part['name'])
+        return parts
+
+    def _merge_parts(self, data_filename, run, object_policy=None):
+        """Stream a run of parts into the first part of the run
+
+        :param data_filename: Appended file in GM Data the parts belong to
+        :param run: Metadata of the consecutive parts to merge
+        :param object_policy: Optional Object Policy for the merged part
+        :return: True on success
+        """
+        first = "{}/{}".format(data_filename, run[0]['name'])
+        codec = self._part_compression(run[0])
+        # compact deletes earlier retired parts before merging, so only
+        # this run's names need to be recorded
+        custom = {"replaces": [part['name'] for part in run[1:]]}
+        if codec:
+            custom["uncompressed_size"] = sum(
+                (part.get('custom') or {}).get('uncompressed_size', 0)
+                for part in run)
+        meta = self.create_meta(first, object_policy=object_policy,
+                                custom=custom)
+
+        with tempfile.TemporaryFile() as f:
+            # raw bytes are concatenated, compressed parts stay compressed
+            for part in run:
+                with requests.get(self.base_url +
+                                  "/stream/{}".format(part['oid']),
+                                  headers=self.headers, stream=True) as r:
+                    r.raise_for_status()
+                    for chunk in r.iter_content(chunk_size=1024 * 1024):
+                        f.write(chunk)
+            f.seek(0)
+
+            multipart_data = MultipartEncoder(
+                fields={"meta": json.dumps([meta]),
+                        "blob": (first, f, meta.get('mimetype'))}
+            )
+
+            headers = copy.copy(self.headers)
+            headers['Content-Type'] = multipart_data.content_type
+            r = requests.post(self.base_url + "/write", data=multipart_data,
+                              headers=headers)
+
+        self.log.debug("The compact sent request")
+        self.log.debug("URL: {}".format(r.request.url))
+        self.log.debug("Response")
+        self.log.debug(r.status_code)
+
+        ok = r.ok
+        r.close()
+        return ok
+
+    @staticmethod
+    def _live_parts(parts):
+        """Drop the parts that a merged part has replaced
+
+        :param parts: Metadata of the parts as returned by `_list_parts`
+        :return: List of the parts that have not been retired by `compact`
+        """
+        retired = set()
+        for part in parts:
+            retired.update((part.get('custom') or {}).get('replaces') or [])
+        return [part for part in parts if part['name'] not in retired]
+
+    @classmethod
+    def _plan_runs(cls, parts, target_part_size):
+        """Group consecutive parts into runs to be merged by `compact`
+
+        :param parts: Metadata of the parts, sorted by name. Each one needs
+            a size, None if it is not known
+        :param target_part_size: Size in bytes a run may grow up to
+        :return: List of runs, each a list of consecutive parts
+        """
+        runs = []
+        size = 0
+        for part in parts:
+            part_size = part.get('size')
+            mergeable = (part_size is not None and
+                         not cls._is_array_part(part))
+            if (runs and mergeable and size is not None and
+                    cls._part_compression(part) ==
+                    cls._part_compression(runs[-1][0]) and
+                    size + part_size <= target_part_size):
+                runs[-1].append(part)
+                size += part_size
+            else:
+                runs.append([part])
+                size = part_size if mergeable else None
+        return runs
+
+    def _load_array_part(self, part, cache_dir=None):
+        """Load the array held in a part written by `append_array`
+
+        :param part: Metadata of the part as returned by a listing
+        :param cache_dir: Optional directory to cache the part in
+        :return: NumPy array of the part
+        """
+        import numpy as np
+
+        codec = self._part_compression(part)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            cached = os.path.join(cache_dir, "{}-{}.npy".format(
+                part['oid'], part.get('tstamp', '')))
+            if not os.path.exists(cached):
+                f = tempfile.NamedTemporaryFile(dir=cache_dir, delete=False,
+                                                prefix=".pygmdata-")
+                try:
+                    with f, requests.get(self.base_url +
+                                         "/stream/{}".format(part['oid']),
+                                         headers=self.headers,
+                                         stream=True) as r:
+                        r.raise_for_status()
+                        chunks = r.iter_content(chunk_size=1024 * 1024)
+                        for chunk in self._decompress_chunks(chunks, codec):
+                            f.write(chunk)
+                    os.replace(f.name, cached)
+                except BaseException:
+                    os.remove(f.name)
+                    raise
+            return np.load(cached, mmap_mode='r', allow_pickle=False)
+
+        with requests.get(self.base_url + "/stream/{}".format(part['oid']),
+                          headers=self.headers, stream=True) as r:
+            r.raise_for_status()
+            chunks = r.iter_content(chunk_size=1024 * 1024)
+            content = b"".join(self._decompress_chunks(chunks, codec))
+        return self._frombuffer_npy(content)
+
+    @staticmethod
+    def _frombuffer_npy(content):
+        """Load the contents of a `.npy` file without copying the data
+
+        :param content: Bytes of a `.npy` file
+        :return: Read only NumPy array backed by content
+        """
+        import numpy as np
+
+        f = io.BytesIO(content)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            header = np.lib.format.read_array_header_1_0(f)
+        elif version == (2, 0):
+            header = np.lib.format.read_array_header_2_0(f)
+        else:
+            return np.load(f, allow_pickle=False)
+        shape, fortran_order, dtype = header
+        array = np.frombuffer(content, dtype=dtype,
+                              count=int(np.prod(shape)), offset=f.tell())
+        return array.reshape(shape, order='F' if fortran_order else 'C')
+
+    @staticmethod
+    def _is_array_part(part):
+        """Check if a listed part was written by `append_array`
+
+        :param part: Metadata of the part as returned by a listing
+        :return: True if the part holds a `.npy` chunk
+        """
+        return 'dtype' in (part.get('custom') or {})
+
+    @staticmethod
+    def _part_compression(part):
+        """Get the codec a listed part was compressed with
+
+        :param part: Metadata of the part as returned by a listing
+        :return: Codec name or None
+        """
+        return (part.get('custom') or {}).get('compression')
+
+    def _select_tree(self, data_dir, include=None, exclude=None):
+        """Pick the objects below a directory for `download_tree`
+
+        :param data_dir: Directory within GM-Data
+        :param include: Optional list of glob patterns to keep
+        :param exclude: Optional list of glob patterns to drop
+        :return: Dictionary of paths relative to data_dir and their oids
+        """
+        prefix = str(data_dir).rstrip("/")
+        oid = self.find_file(prefix) if prefix else 1
+        if not oid:
+            self.log.warning("Cannot find directory in GM-Data to download.")
+            return {}
+
+        # relist only this subtree, dropping anything deleted since the
+        # hierarchy was last populated
+        for path in list(self.hierarchy.keys()):
+            if str(path).startswith(prefix + "/"):
+                del self.hierarchy[path]
+        self.populate_hierarchy(prefix or "/", oid)
+
+        targets = {}
+        for path, oid in list(self.hierarchy.items()):
+            path = str(path)
+            if not path.startswith(prefix + "/"):
+                continue
+            rel = path[len(prefix) + 1:]
+            if include and not any(fnmatch.fnmatch(rel, pattern)
+                                   for pattern in include):
+                continue
+            if exclude and any(fnmatch.fnmatch(rel, pattern)
+                               for pattern in exclude):
+                continue
+            targets[rel] = oid
+        return targets
+
+    def _download_tree_object(self, oid, local_filename, chunk_size=8192,
+                              mode=0o644):
+        """Download a single object for `download_tree`
+
+        :param oid: The GM Data oid of the object
+        :param local_filename: Path to write the object to
+        :param chunk_size: Size of chunks to be used
+        :param mode: Permissions to give the written file
+        :return: None if the object is a directory, False if the local copy
+            already matches or the number of bytes written
+        """
+        r = requests.get(self.base_url + '/props/{}'.format(oid),
+                         headers=self.headers)
+        r.raise_for_status()
+        props = r.json()
+        r.close()
+
+        if not props.get('isfile'):
+            os.makedirs(local_filename, exist_ok=True)
+            return None
+
+        custom = props.get('custom') or {}
+        codec = custom.get('compression')
+        size = custom.get('uncompressed_size') if codec else props.get('size')
+        tstamp = self._tstamp_ns(props.get('tstamp'))
+        if (size is not None and tstamp is not None and
+                os.path.isfile(local_filename)):
+            stat = os.stat(local_filename)
+            if stat.st_size == size and stat.st_mtime_ns == tstamp:
+                self.log.debug("{} is up to date".format(local_filename))
+                return False
+
+        directory = os.path.dirname(local_filename)
+        os.makedirs(directory, exist_ok=True)
+        written = 0
+        f = tempfile.NamedTemporaryFile(dir=directory, delete=False,
+                                        prefix=".pygmdata-")
+        try:
+            with f, requests.get(self.base_url+"/stream/{}".format(oid),
+                                 headers=self.headers, stream=True) as r:
+                r.raise_for_status()
+                chunks = r.iter_content(chunk_size=chunk_size)
+                for chunk in self._decompress_chunks(chunks, codec):
+                    f.write(chunk)
+                    written += len(chunk)
+            os.chmod(f.name, mode)
+            if tstamp is not None:
+                os.utime(f.name, ns=(tstamp, tstamp))
+            os.replace(f.name, local_filename)
+        except BaseException:
+            os.remove(f.name)
+            raise
+        return written
+
+    @staticmethod
+    def _tstamp_ns(tstamp):
+        """Convert a GM-Data tstamp into nanoseconds since the epoch
+
+        GM-Data gives tstamps as hex strings. Numbers in seconds, milli-,
+        micro- or nanoseconds are accepted as well.
+
+        :param tstamp: The tstamp from an object's props
+        :return: Nanoseconds since the epoch or None if it cannot be parsed
+        """
+        if isinstance(tstamp, str):
+            try:
+                tstamp = int(tstamp, 16)
+            except ValueError:
+                try:
+                    tstamp = float(tstamp)
+                except ValueError:
+                    return None
+        if not isinstance(tstamp, (int, float)) or tstamp <= 0:
+            return None
+        # scale up to nanoseconds
+        while tstamp < 1e17:
+            tstamp *= 1000
+        if tstamp >= 2 ** 63:
+            return None
+        return int(tstamp)
+
+    def _get_compression(self, oid):
+        """Get the codec an object was compressed with
+
+        :param oid: The GM Data oid of the object
+        :return: Codec name from the object's custom metadata or None
+        """
+        r = requests.get(self.base_url + '/props/{}'.format(oid),
+                         headers=self.headers)
+        custom = r.json().get('custom') or {}
+        r.close()
+        return custom.get('compression')
+
+    def _resolve_compression(self, compression):
+        """Work out which codec to use for an upload
+
+        :param compression: Codec name, None to use the class default or
+            False to disable compression
+        :return: Codec name or None
+        """
+        if compression is None:
+            compression = self.compression
+        if not compression:
+            return None
+        if compression not in CODECS:
+            raise ValueError("Unknown compression {}. Must be one of "
+                             "{}".format(compression, list(CODECS.keys())))
+        return compression
+
+    @staticmethod
+    def _compress_stream(f, codec, chunk_size=1024 * 1024):
+        """Compress a file object into a temporary file
+
+        :param f: Readable binary file object. It is closed once compressed.
+        :param codec: Name of the codec in `CODECS` to compress with
+        :param chunk_size: Size of chunks to read from f
+        :return: Temporary file holding the compressed data, rewound to
+            the start
+        """
+        opener = CODECS[codec][0]
+        out = tempfile.TemporaryFile()
+        with f, opener(out, 'wb') as z:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                z.write(chunk)
+        out.seek(0)
+        return out
+
+    @staticmethod
+    def _decompress_chunks(chunks, codec):
+        """Incrementally decompress an iterable of byte chunks
+
+        Concatenated compressed streams, such as merged parts, are
+        decompressed one after another.
+
+        :param chunks: Iterable of compressed bytes
+        :param codec: Name of the codec in `CODECS`. If None the chunks are
+            passed through untouched
+        :return: Generator of decompressed bytes
+        :raises EOFError: If the last compressed stream is truncated
+        """
+        if not codec:
+            yield from chunks
+            return
+
+        new_decompressor = CODECS[codec][1]
+        d = new_decompressor()
+        consumed = False
+        for chunk in chunks:
+            while chunk:
+                consumed = True
+                out = d.decompress(chunk)
+                if out:
+                    yield out
+                if d.eof:
+                    chunk = d.unused_data
+                    d = new_decompressor()
+                    consumed = False
+                else:
+                    chunk = b""
+        if consumed:
+            raise EOFError("Compressed {} stream ended before the "
+                           "end-of-stream marker was reached".format(codec))
+
     @staticmethod
     def start_logger(name="pygmdata", logfile=None):
         """Start logging what is going on
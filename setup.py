@@ -30,6 +30,7 @@ setup(
     packages=["pygmdata"],
     include_package_data=True,
     install_requires=["requests", "requests_toolbelt"],
+    extras_require={"array": ["numpy"]},
     entry_points={
         "console_scripts": [
             "pygmdata=pygmdata.__main__:main",
@@ -1,5 +1,30 @@
+import gzip
+import io
+import os
+import tempfile
 import unittest
-from pygmdata.pygmdata import Data
+from unittest import mock
+try:
+    import numpy as np
+except ImportError:
+    np = None
+from pygmdata.pygmdata import Data, CODECS
+
+
+def make_data(**kwargs):
+    """Make a Data instance without talking to a GM-Data server"""
+    with mock.patch.object(Data, "populate_hierarchy"):
+        return Data("http://localhost:8181", **kwargs)
+
+
+def mock_response(json=None, chunks=None):
+    """Make a mocked requests response"""
+    r = mock.MagicMock()
+    r.ok = True
+    r.json.return_value = json
+    r.iter_content.return_value = chunks or []
+    r.__enter__.return_value = r
+    return r
 
 
 class TestData(unittest.TestCase):
@@ -15,6 +40,378 @@ class TestData(unittest.TestCase):
         self.assertEqual(d.user_dn, user_dn)
 
 
+class TestCompression(unittest.TestCase):
+
+    data = b"line of a highly compressible log\n" * 1000
+
+    def compress(self, data, codec):
+        with Data._compress_stream(io.BytesIO(data), codec) as f:
+            return f.read()
+
+    @staticmethod
+    def split(blob, size=100):
+        return [blob[i:i + size] for i in range(0, len(blob), size)]
+
+    def test_round_trip(self):
+        for codec in CODECS:
+            blob = self.compress(self.data, codec)
+            self.assertLess(len(blob), len(self.data))
+            out = b"".join(Data._decompress_chunks(self.split(blob), codec))
+            self.assertEqual(out, self.data, codec)
+
+    def test_concatenated_streams(self):
+        for codec in CODECS:
+            blob = (self.compress(self.data, codec) +
+                    self.compress(b"more", codec))
+            out = b"".join(Data._decompress_chunks(self.split(blob), codec))
+            self.assertEqual(out, self.data + b"more", codec)
+
+    def test_truncated_stream(self):
+        for codec in CODECS:
+            blob = self.compress(self.data, codec)[:-5]
+            with self.assertRaises(EOFError, msg=codec):
+                b"".join(Data._decompress_chunks(self.split(blob), codec))
+
+    def test_no_codec(self):
+        chunks = [b"a", b"b"]
+        self.assertEqual(list(Data._decompress_chunks(chunks, None)), chunks)
+
+    def test_resolve_compression(self):
+        d = make_data(compression="gzip")
+        self.assertEqual(d._resolve_compression(None), "gzip")
+        self.assertEqual(d._resolve_compression("lzma"), "lzma")
+        self.assertIsNone(d._resolve_compression(False))
+        with self.assertRaises(ValueError):
+            d._resolve_compression("zip")
+
+    @mock.patch("pygmdata.pygmdata.requests")
+    def test_download_file_decompresses(self, requests):
+        d = make_data()
+        d.hierarchy["/world/log.txt"] = 7
+        blob = gzip.compress(self.data)
+        requests.get.side_effect = [
+            mock_response({"custom": {"compression": "gzip"}}),
+            mock_response(chunks=self.split(blob)),
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            local = os.path.join(tmp, "log.txt")
+            self.assertEqual(d.download_file("/world/log.txt", local), local)
+            with open(local, "rb") as f:
+                self.assertEqual(f.read(), self.data)
+
+
+def part(name, size=10, **custom):
+    """Make the listed metadata of a part"""
+    return {"name": name, "oid": name, "size": size, "isfile": True,
+            "custom": custom}
+
+
+class TestCompact(unittest.TestCase):
+
+    def test_plan_runs(self):
+        parts = [part("aaa"), part("aab"), part("aac"), part("aad")]
+        runs = Data._plan_runs(parts, 25)
+        self.assertEqual([[p["name"] for p in run] for run in runs],
+                         [["aaa", "aab"], ["aac", "aad"]])
+
+    def test_plan_runs_keeps_codecs_apart(self):
+        parts = [part("aaa"), part("aab", compression="gzip"),
+                 part("aac", compression="gzip"), part("aad")]
+        runs = Data._plan_runs(parts, 100)
+        self.assertEqual([[p["name"] for p in run] for run in runs],
+                         [["aaa"], ["aab", "aac"], ["aad"]])
+
+    def test_plan_runs_unknown_size_and_arrays(self):
+        parts = [part("aaa"), part("aab", size=None), part("aac"),
+                 part("aad", dtype="<f8", shape=[2]), part("aae")]
+        runs = Data._plan_runs(parts, 100)
+        self.assertEqual([[p["name"] for p in run] for run in runs],
+                         [["aaa"], ["aab"], ["aac"], ["aad"], ["aae"]])
+
+    def test_live_parts(self):
+        parts = [part("aaa", replaces=["aab", "aac"]), part("aab"),
+                 part("aac"), part("aad")]
+        self.assertEqual([p["name"] for p in Data._live_parts(parts)],
+                         ["aaa", "aad"])
+
+    def compact(self, parts, delete_ok=True):
+        d = make_data()
+        with mock.patch.object(d, "find_file", return_value=1), \
+                mock.patch.object(d, "_list_parts", return_value=parts), \
+                mock.patch.object(d, "_merge_parts",
+                                  return_value=True) as merge, \
+                mock.patch.object(d, "delete_file",
+                                  return_value=delete_ok) as delete:
+            result = d.compact("/log", target_part_size=100)
+        return result, merge, delete
+
+    def test_compact(self):
+        parts = [part("aaa"), part("aab"), part("aac"), part("aad")]
+        result, merge, delete = self.compact(parts)
+        self.assertIs(result, True)
+        merge.assert_called_once_with("/log", parts[:3], None)
+        self.assertEqual(delete.call_args_list,
+                         [mock.call("/log/aab"), mock.call("/log/aac")])
+
+    def test_compact_nothing_to_do(self):
+        result, merge, delete = self.compact([part("aaa"), part("aab")])
+        self.assertIsNone(result)
+        merge.assert_not_called()
+        delete.assert_not_called()
+
+    def test_compact_failed_delete(self):
+        parts = [part("aaa"), part("aab"), part("aac"), part("aad")]
+        result, merge, delete = self.compact(parts, delete_ok=False)
+        self.assertIs(result, False)
+        delete.assert_called_once_with("/log/aab")
+
+    def test_compact_finishes_retired_deletes(self):
+        parts = [part("aaa", replaces=["aab"]), part("aab"), part("aac")]
+        result, merge, delete = self.compact(parts)
+        self.assertIs(result, True)
+        delete.assert_called_once_with("/log/aab")
+        merge.assert_not_called()
+
+    @mock.patch("pygmdata.pygmdata.requests")
+    def test_merge_parts_again(self, requests):
+        d = make_data()
+        run = [part("aaa", replaces=["aab", "aac", "aad"]), part("aae")]
+        requests.get.return_value = mock_response(chunks=[b"data"])
+        with mock.patch.object(d, "create_meta",
+                               return_value={"mimetype": None}) as meta:
+            self.assertTrue(d._merge_parts("/log", run))
+        self.assertEqual(meta.call_args[1]["custom"], {"replaces": ["aae"]})
+
+    def test_list_parts(self):
+        d = make_data()
+        parts = [part("aaa", replaces=["aab"]), part("aab"), part("aac")]
+        with mock.patch.object(d, "find_file", return_value=1), \
+                mock.patch.object(d, "_list_parts", return_value=parts):
+            self.assertEqual([p["name"] for p in d.list_parts("/log")],
+                             ["aaa", "aac"])
+
+    @mock.patch("pygmdata.pygmdata.requests")
+    def test_stream_parts(self, requests):
+        d = make_data()
+        parts = [part("aaa", replaces=["aab"]), part("aab"),
+                 part("aac", compression="gzip")]
+        streams = {"/stream/aaa": [b"one\n", b"two\n"],
+                   "/stream/aab": [b"two\n"],
+                   "/stream/aac": [gzip.compress(b"three\n")]}
+        requests.get.side_effect = lambda url, **kwargs: mock_response(
+            chunks=streams[url[len(d.base_url):]])
+        with mock.patch.object(d, "find_file", return_value=1), \
+                mock.patch.object(d, "_list_parts", return_value=parts):
+            self.assertEqual(b"".join(d.stream_parts("/log")),
+                             b"one\ntwo\nthree\n")
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class TestArray(unittest.TestCase):
+
+    @staticmethod
+    def npy(array):
+        f = io.BytesIO()
+        np.save(f, array)
+        return f.getvalue()
+
+    def test_frombuffer_npy(self):
+        a = np.arange(12, dtype="<f4").reshape(4, 3)
+        for order in (a, np.asfortranarray(a)):
+            out = Data._frombuffer_npy(self.npy(order))
+            np.testing.assert_array_equal(out, a)
+            self.assertFalse(out.flags.writeable)
+
+    def read_array(self, start=None, stop=None):
+        d = make_data()
+        chunks = {"aaa": np.arange(0, 3), "aab": np.arange(3, 5),
+                  "aac": np.arange(5, 9)}
+        parts = [part(name, dtype=chunk.dtype.str, shape=list(chunk.shape))
+                 for name, chunk in chunks.items()]
+        with mock.patch.object(d, "find_file", return_value=1), \
+                mock.patch.object(d, "_list_parts", return_value=parts), \
+                mock.patch.object(d, "_load_array_part",
+                                  side_effect=lambda p, c: chunks[p["name"]]
+                                  ) as load:
+            out = d.read_array("/sensors", start, stop)
+        return out, [c[0][0]["name"] for c in load.call_args_list]
+
+    def test_read_array(self):
+        out, loaded = self.read_array()
+        np.testing.assert_array_equal(out, np.arange(9))
+        self.assertEqual(loaded, ["aaa", "aab", "aac"])
+
+    def test_read_array_row_range(self):
+        out, loaded = self.read_array(3, 6)
+        np.testing.assert_array_equal(out, np.arange(3, 6))
+        self.assertEqual(loaded, ["aab", "aac"])
+
+    def test_read_array_single_part(self):
+        out, loaded = self.read_array(-2)
+        np.testing.assert_array_equal(out, np.arange(7, 9))
+        self.assertEqual(loaded, ["aac"])
+
+    def test_read_array_empty_range(self):
+        out, loaded = self.read_array(4, 4)
+        self.assertEqual(out.shape, (0,))
+        self.assertEqual(loaded, [])
+
+    def test_append_array_mismatch(self):
+        d = make_data()
+        parts = [part("aaa", dtype="<f8", shape=[2, 3])]
+        with mock.patch.object(d, "find_file", return_value=1), \
+                mock.patch.object(d, "_list_parts", return_value=parts):
+            with self.assertRaises(ValueError):
+                d.append_array(np.zeros((2, 4)), "/sensors")
+            with self.assertRaises(ValueError):
+                d.append_array(np.zeros((2, 3), dtype="<i4"), "/sensors")
+
+    @mock.patch("pygmdata.pygmdata.requests")
+    def test_load_array_part_cache(self, requests):
+        d = make_data()
+        a = np.arange(6).reshape(2, 3)
+        requests.get.return_value = mock_response(chunks=[self.npy(a)])
+        with tempfile.TemporaryDirectory() as tmp:
+            out = d._load_array_part(dict(part("aaa"), tstamp="1"), tmp)
+            np.testing.assert_array_equal(out, a)
+            self.assertIsInstance(out, np.memmap)
+            self.assertEqual(os.listdir(tmp), ["aaa-1.npy"])
+
+    @mock.patch("pygmdata.pygmdata.requests")
+    def test_load_array_part_cache_failure(self, requests):
+        d = make_data()
+        r = mock_response()
+        r.iter_content.side_effect = IOError("connection dropped")
+        requests.get.return_value = r
+        with tempfile.TemporaryDirectory() as tmp:
+            with self.assertRaises(IOError):
+                d._load_array_part(part("aaa"), tmp)
+            self.assertEqual(os.listdir(tmp), [])
+
+
+class TestDownloadTree(unittest.TestCase):
+
+    # what GM-Data currently holds
+    listing = {
+        "/world": 2, "/world/a.txt": 3, "/world/logs": 4,
+        "/world/logs/aaa": 5, "/world/logs/aab": 6, "/other/b.txt": 7,
+    }
+
+    def setUp(self):
+        self.d = make_data()
+        self.d.hierarchy = dict(self.listing)
+
+    def populate(self, path, oid):
+        prefix = "" if path == "/" else path
+        for name, name_oid in self.listing.items():
+            if name.startswith(prefix + "/"):
+                self.d.hierarchy[name] = name_oid
+
+    def select(self, data_dir, include=None, exclude=None):
+        with mock.patch.object(self.d, "populate_hierarchy",
+                               side_effect=self.populate) as populate:
+            targets = self.d._select_tree(data_dir, include, exclude)
+        self.populated = populate.call_args
+        return targets
+
+    def test_select_tree(self):
+        self.assertEqual(self.select("/world/"),
+                         {"a.txt": 3, "logs": 4, "logs/aaa": 5,
+                          "logs/aab": 6})
+        self.assertEqual(self.populated, mock.call("/world", 2))
+        self.assertEqual(len(self.select("/")), 6)
+        self.assertEqual(self.populated, mock.call("/", 1))
+
+    def test_select_tree_drops_stale_entries(self):
+        self.d.hierarchy["/world/logs/aac"] = 8
+        self.d.hierarchy["/other/c.txt"] = 9
+        self.assertNotIn("logs/aac", self.select("/world"))
+        # only the requested subtree is relisted
+        self.assertEqual(self.d.hierarchy["/other/c.txt"], 9)
+
+    def test_select_tree_include_exclude(self):
+        self.assertEqual(self.select("/world", include=["*.txt"]),
+                         {"a.txt": 3})
+        self.assertEqual(self.select("/world", exclude=["logs*"]),
+                         {"a.txt": 3})
+        self.assertEqual(self.select("/world", include=["logs/*"],
+                                     exclude=["*/aab"]),
+                         {"logs/aaa": 5})
+
+    def test_download_tree_outside_local_dir(self):
+        targets = {"../evil.txt": 3, "logs/../../evil.txt": 4, "..": 5,
+                   "ok.txt": 6}
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch.object(self.d, "_select_tree",
+                                  return_value=targets), \
+                mock.patch.object(self.d, "_download_tree_object",
+                                  return_value=1) as download:
+            summary = self.d.download_tree("/world", tmp)
+            download.assert_called_once()
+            self.assertEqual(download.call_args[0][1],
+                             os.path.join(os.path.realpath(tmp), "ok.txt"))
+        self.assertEqual(summary["failed"], 3)
+        self.assertEqual(summary["files"], 1)
+
+    def test_tstamp_ns(self):
+        self.assertEqual(Data._tstamp_ns(hex(1608262398 * 10 ** 9)),
+                         1608262398 * 10 ** 9)
+        self.assertEqual(Data._tstamp_ns(1608262398), 1608262398 * 10 ** 9)
+        self.assertEqual(Data._tstamp_ns(1608262398000),
+                         1608262398 * 10 ** 9)
+        self.assertIsNone(Data._tstamp_ns(None))
+        self.assertIsNone(Data._tstamp_ns("not a time"))
+
+    @mock.patch("pygmdata.pygmdata.requests")
+    def test_download_tree_object(self, requests):
+        tstamp = 1608262398 * 10 ** 9
+
+        def download(local, data, tstamp):
+            props = {"isfile": True, "size": len(data),
+                     "tstamp": hex(tstamp)}
+            requests.get.side_effect = [mock_response(props),
+                                        mock_response(chunks=[data])]
+            return self.d._download_tree_object(3, local, mode=0o640)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            local = os.path.join(tmp, "world", "a.txt")
+            self.assertEqual(download(local, b"hello", tstamp), 5)
+            stat = os.stat(local)
+            self.assertEqual(stat.st_mode & 0o777, 0o640)
+            self.assertEqual(stat.st_mtime_ns, tstamp)
+            self.assertEqual(os.listdir(os.path.dirname(local)), ["a.txt"])
+
+            # unchanged objects are skipped
+            self.assertIs(download(local, b"hello", tstamp), False)
+
+            # rewritten with the same length
+            self.assertEqual(download(local, b"world", tstamp + 1), 5)
+            with open(local, "rb") as f:
+                self.assertEqual(f.read(), b"world")
+
+    def test_download_tree(self):
+        results = {"a.txt": 5, "logs": None, "logs/aaa": False,
+                   "logs/aab": IOError("connection dropped")}
+
+        def download(oid, local, chunk_size, mode):
+            rel = os.path.relpath(local, os.path.realpath(tmp))
+            result = results[rel.replace(os.sep, "/")]
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch.object(self.d, "populate_hierarchy",
+                                  side_effect=self.populate), \
+                mock.patch.object(self.d, "_download_tree_object",
+                                  side_effect=download):
+            summary = self.d.download_tree("/world", tmp)
+        self.assertEqual(summary["files"], 1)
+        self.assertEqual(summary["skipped"], 1)
+        self.assertEqual(summary["failed"], 1)
+        self.assertEqual(summary["bytes"], 5)
+
+
 if __name__ == '__main__':
     unittest.main()
 